@@ -79,3 +79,35 @@ class Restaurant(object):
             self.tables[tid][4] = None
 
         return party
+
+    def copy(self):
+        ''' Copy of the restaurant that can be changed without touching this one '''
+        restaurant = Restaurant(only_neighbors=self.only_neighbors)
+        restaurant.tables = {tid : list(v) for tid, v in self.tables.items()}
+        restaurant.table_heap = list(self.table_heap)
+
+        return restaurant
+
+    def redraw_departures(self, seated_time_func, t, tries=100):
+        ''' Redraw how long each seated party stays, given they are still here at t '''
+        parties = {}
+        for d, tid, party in self.table_heap:
+            if party[0] in parties:
+                continue
+
+            start = d - party[2]
+            parties[party[0]] = party
+            for i in range(tries):
+                length = seated_time_func(party[1])
+                if start + length > t:
+                    parties[party[0]] = (party[0], party[1], length) + party[3:]
+                    break
+
+        heap = []
+        for d, tid, party in self.table_heap:
+            new_party = parties[party[0]]
+            heap.append((d - party[2] + new_party[2], tid, new_party))
+            self.tables[tid][4] = new_party
+
+        heapq.heapify(heap)
+        self.table_heap = heap
@@ -1,3 +1,5 @@
+import copy
+import math
 import random
 from pprint import pprint
 
@@ -26,7 +28,7 @@ def arrival_func(t):
     return (size, time + t)
 
 
-def var_arrival(t):
+def arrival_interval(t):
     if t <= PEAK_START:
         l = BASE_ARR
     elif t <= PEAK_START + PEAK_SCALE:
@@ -38,6 +40,25 @@ def var_arrival(t):
     else:
         l = BASE_ARR
 
+    return l
+
+
+def var_arrival(t):
+    l = arrival_interval(t)
+
+    u = random.random()
+    size = get_size(u)
+
+    time = random.expovariate(1.0 / l)
+
+    return (size, time + t)
+
+
+def cyclic_arrival(t):
+    # same as var_arrival, but the night's rate pattern repeats every
+    # OPEN_TIME minutes so it can be used for a long run
+    l = arrival_interval(t % OPEN_TIME)
+
     u = random.random()
     size = get_size(u)
 
@@ -46,103 +67,207 @@ def var_arrival(t):
     return (size, time + t)
 
 
+def t_quantile(df):
+    # t value for a 95% confidence interval - past the end of the table we
+    # round df down, which only makes the interval a little wider
+    assert df >= 1, 'need at least 2 samples for a confidence interval!'
+    if df > max(T_975):
+        return CI_Z
+
+    return T_975[max(k for k in T_975 if k <= df)]
+
+
 def renege_time(t):
     return random.expovariate(1.0 / RENEGE_RATE) + t
 
 
-def sim_night(restaurant, seater, arrival_func, seated_time_func, renege_func, t_max):
-    next_arrival = arrival_func(0)
-    next_departure = restaurant.get_next_departure()
-    to_seat = []
+class Night(object):
+    ''' State of a single night, advanced one event at a time by step()
+
+    Keeping the state in one object means a night can be copied part way
+    through, which multilevel_split uses to clone nights that look bad.
+    '''
+
+    def __init__(self, restaurant, seater, arrival_func, seated_time_func, renege_func, t_max):
+        self.restaurant = restaurant
+        self.seater = seater
+        self.arrival_func = arrival_func
+        self.seated_time_func = seated_time_func
+        self.renege_func = renege_func
+        self.t_max = t_max
+
+        self.next_arrival = arrival_func(0)
+        self.next_departure = restaurant.get_next_departure()
+        self.to_seat = []
+
+        self.party_log = {}
+
+        self.t = 0
+        self.pid = 0
+        self.last_arrival = 0
+
+        # parties the last arrival's queue check kept and dropped, which
+        # redraw needs to stay consistent with
+        self.kept_pids = []
+        self.dropped_pids = []
 
-    party_log = {}
+        # running totals so splitting can check levels without the whole log
+        self.parties_seated = 0
+        self.max_wait = 0
+
+    def is_open(self):
+        return self.t_max > self.next_arrival[1]
+
+    def is_done(self):
+        return not self.is_open() and self.restaurant.is_empty()
+
+    def log_renege(self):
+        # let people leave the queue
+        for p in self.to_seat:
+            if p[3] < self.t:
+                self.party_log[p[0]]['r_time'] = p[3]
+                self.max_wait = max(self.max_wait, p[3] - self.party_log[p[0]]['a_time'])
+
+    def seat_parties(self):
+        # process people who coculd be seated
+        pairings = self.seater.find_seats(self.to_seat, self.restaurant.get_available_tables(), self.t)
+
+        # seat parties and remove them from to_seat
+        seated = set()
+        for tid, party in pairings:
+            seated.add(party[0])
+            self.party_log[party[0]]['s_time'] = self.t
+            self.restaurant.add_party(tid, party, self.t)
+            self.parties_seated += 1
+            self.max_wait = max(self.max_wait, self.t - self.party_log[party[0]]['a_time'])
+
+        # update time of next departure
+        self.next_departure = self.restaurant.get_next_departure()
+        self.to_seat = [p for p in self.to_seat if p[0] not in seated]
 
-    t = 0
-    pid = 0
+    def step(self):
+        if not self.is_open():
+            # once the restaurant closes, we let everyone finish eating
+            # but we don't seat anyone else
+            self.t = self.next_departure
+
+            party = self.restaurant.do_departure()
+            self.party_log[party[0]]['d_time'] = self.t
+
+            self.next_departure = self.restaurant.get_next_departure()
 
-    while t_max > next_arrival[1]:
         # if the next event is an arrival
-        if next_arrival[1] <= next_departure:
+        elif self.next_arrival[1] <= self.next_departure:
             # update time
-            t = next_arrival[1]
-            to_seat.append((pid, next_arrival[0], seated_time_func(next_arrival[0]), renege_func(t)))
-            party_log[pid] = {
-                'party_size' : next_arrival[0],
-                'a_time' : t,
+            self.t = self.next_arrival[1]
+            size = self.next_arrival[0]
+            self.to_seat.append((self.pid, size, self.seated_time_func(size), self.renege_func(self.t)))
+            self.party_log[self.pid] = {
+                'party_size' : size,
+                'a_time' : self.t,
                 's_time' : -1,
                 'd_time' : -1,
                 'r_time' : -1
             }
-            pid += 1
+            self.pid += 1
             # get next arrival
-            next_arrival = arrival_func(t)
+            self.last_arrival = self.t
+            self.next_arrival = self.arrival_func(self.t)
 
-            # let people leave the queue
-            for p in to_seat:
-                if p[3] < t:
-                    party_log[p[0]]['r_time'] = p[3]
+            self.log_renege()
 
-            to_seat = [p for p in to_seat if next_arrival[1] < p[3]]
+            # who gets dropped here depends on next_arrival (see redraw)
+            self.kept_pids = [p[0] for p in self.to_seat if self.next_arrival[1] < p[3]]
+            self.dropped_pids = [p[0] for p in self.to_seat if self.t <= p[3] <= self.next_arrival[1]]
 
-            # process people who coculd be seated
-            pairings = seater.find_seats(to_seat, restaurant.get_available_tables(), t)
+            self.to_seat = [p for p in self.to_seat if self.next_arrival[1] < p[3]]
 
-            # seat parties and remove them from to_seat
-            seated = set()
-            for tid, party in pairings:
-                seated.add(party[0])
-                party_log[party[0]]['s_time'] = t
-                restaurant.add_party(tid, party,t)
-
-            next_departure = restaurant.get_next_departure()
-            to_seat = [p for p in to_seat if p[0] not in seated]
+            self.seat_parties()
 
         # if the next event is a departure
         else:
             # update time
-            t = next_departure
+            self.t = self.next_departure
 
             # process departure and log info
-            party = restaurant.do_departure()
-
-            party_log[party[0]]['d_time'] = t
-
-            # let people leave the queue
-            for p in to_seat:
-                if p[3] < t:
-                    party_log[p[0]]['r_time'] = p[3]
-
-            to_seat = [p for p in to_seat if next_departure < p[3]]
-
-            # process people who coculd be seated
-            pairings = seater.find_seats(to_seat, restaurant.get_available_tables(), t)
-
-            # and we will try to seat parties and remove then from to_seat
-            seated = set()
-            for tid, party in pairings:
-                seated.add(party[0])
-                party_log[party[0]]['s_time'] = t
-                restaurant.add_party(tid, party, t)
+            party = self.restaurant.do_departure()
+            self.party_log[party[0]]['d_time'] = self.t
+
+            self.log_renege()
+            self.to_seat = [p for p in self.to_seat if self.next_departure < p[3]]
+
+            self.seat_parties()
+
+    def clone(self):
+        # much cheaper than deepcopy - the log entries are the only deep part
+        # that changes, and party tuples are never modified
+        night = copy.copy(self)
+        night.restaurant = self.restaurant.copy()
+        night.seater = copy.deepcopy(self.seater)
+        night.to_seat = list(self.to_seat)
+        night.party_log = {pid : dict(v) for pid, v in self.party_log.items()}
+
+        return night
+
+    def draw_renege(self, pid, lo, tries):
+        # renege time for party pid, given it is after lo
+        for i in range(tries):
+            r = self.renege_func(self.party_log[pid]['a_time'])
+            if r > lo:
+                return r
+
+        return None
+
+    def redraw(self, tries=100):
+        # a lot of the future is drawn ahead of time: the next arrival, how
+        # patient the queued parties are and how long everyone eats. clones
+        # that share all of that barely differ, so this draws it again given
+        # only what the night has used so far: seated parties are still
+        # eating at t, the next arrival is after t and before t_max (we only
+        # get here while open), and the last arrival's queue check kept
+        # everyone whose renege time is after it and dropped the rest. the
+        # arrival and the renege times are tried together and a try that
+        # breaks any of that is thrown away whole. if every try does we keep
+        # what we had. check_redraw shows this leaves the nights unchanged
+        if not self.is_open():
+            return
+
+        self.restaurant.redraw_departures(self.seated_time_func, self.t, tries)
+        self.next_departure = self.restaurant.get_next_departure()
+
+        # nothing has used how long the queued parties will eat
+        self.to_seat = [(p[0], p[1], self.seated_time_func(p[1]), p[3]) for p in self.to_seat]
+
+        for i in range(tries):
+            next_arrival = self.arrival_func(self.last_arrival)
+            if not self.t < next_arrival[1] < self.t_max:
+                continue
+
+            # kept reneges are after next_arrival, which is after t, and
+            # dropped ones were not logged so they are after the last arrival
+            kept = {pid : self.draw_renege(pid, self.t, tries) for pid in self.kept_pids}
+            dropped = [self.draw_renege(pid, self.last_arrival, tries) for pid in self.dropped_pids]
+            if None in kept.values() or None in dropped:
+                continue
+
+            if any(r <= next_arrival[1] for r in kept.values()) or any(r > next_arrival[1] for r in dropped):
+                continue
+
+            # everyone still queued was kept at the last arrival
+            self.next_arrival = next_arrival
+            self.to_seat = [(p[0], p[1], p[2], kept[p[0]]) for p in self.to_seat]
+            return
+
+    def run(self):
+        while not self.is_done():
+            self.step()
+
+        return self.party_log
 
-            # update time of next departure
-            next_departure = restaurant.get_next_departure()
 
-            to_seat = [p for p in to_seat if p[0] not in seated]
-
-    # once the restaurant closes, we let everyone finish eating
-    # but we don't seat anyone else
-    while not restaurant.is_empty():
-        # update time
-        t = next_departure
-
-        # process departure and log info
-        party = restaurant.do_departure()
-        party_log[party[0]]['d_time'] = t
-
-        # update time of next departure
-        next_departure = restaurant.get_next_departure()
-
-    return party_log
+def sim_night(restaurant, seater, arrival_func, seated_time_func, renege_func, t_max):
+    night = Night(restaurant, seater, arrival_func, seated_time_func, renege_func, t_max)
+    return night.run()
 
 def calculate_metrics(results):
     # number of parties
@@ -206,6 +331,272 @@ def monte_carlo(restaurant, seater, arrival_func, sample_seated_time, renege_fun
     return metrics
 
 
+def mser_truncation(series):
+    # MSER warm-up rule: drop the first d values, where d minimizes the
+    # squared standard error of the mean of what is left. only the first
+    # half of the series is considered. sums over each tail are built from
+    # the back once so every d costs the same
+    n = len(series)
+    best_d = 0
+    best = float('inf')
+
+    tail_sum = [0.0] * (n + 1)
+    tail_sq = [0.0] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        tail_sum[i] = tail_sum[i + 1] + series[i]
+        tail_sq[i] = tail_sq[i + 1] + series[i] ** 2
+
+    for d in range(n // 2 + 1):
+        m = n - d
+        score = (tail_sq[d] - tail_sum[d] ** 2 / m) / m ** 2
+
+        if score < best:
+            best = score
+            best_d = d
+
+    return best_d
+
+
+def steady_state(restaurant, seater, arrival_func, seated_time_func, renege_func, t_max,
+                 n_batches=20, bin_width=30, period=None, warmup_key='avg_wait_time'):
+    # runs one long night of t_max minutes (use arrival_func for a fixed rate
+    # or cyclic_arrival with period=OPEN_TIME for a repeating night) and
+    # estimates the steady state metrics with batch means. parties are split
+    # into bins of bin_width minutes by arrival time, the warm-up is found by
+    # running MSER on warmup_key, and the rest are grouped into n_batches
+    # batches. with a period, MSER runs on whole periods and every batch is a
+    # whole number of periods, so no batch gets more of the peak than another.
+    # counts are scaled to an OPEN_TIME night so they line up with monte_carlo
+    assert period or arrival_func is not cyclic_arrival, 'cyclic_arrival needs period=OPEN_TIME!'
+    assert n_batches >= 2, 'need at least 2 batches for a confidence interval!'
+
+    # bins per period, so everything below can be done in whole periods
+    if period:
+        assert period % bin_width == 0, 'period must be a multiple of bin_width!'
+        per_period = period // bin_width
+    else:
+        per_period = 1
+
+    results = sim_night(restaurant, seater, arrival_func, seated_time_func, renege_func, t_max)
+
+    # parties still in the queue at close are counted as dropped, so leave
+    # out the ones that arrived near the end
+    horizon = t_max - 5 * RENEGE_RATE
+    n_bins = int(horizon // bin_width) // per_period * per_period
+
+    bins = [{} for i in range(n_bins)]
+    for pid, v in results.items():
+        b = int(v['a_time'] // bin_width)
+        if b < n_bins:
+            bins[b][pid] = v
+
+    series = []
+    for i in range(0, n_bins, per_period):
+        log = {}
+        for b in bins[i : i + per_period]:
+            log.update(b)
+
+        series.append(calculate_metrics(log)[warmup_key])
+
+    warmup = mser_truncation(series) * per_period
+
+    # if the bins don't split evenly, drop the extra ones right after warm-up
+    per_batch = (n_bins - warmup) // n_batches // per_period * per_period
+    assert per_batch > 0, 't_max is too short for {} batches'.format(n_batches)
+    start = n_bins - per_batch * n_batches
+    batch_length = per_batch * bin_width
+
+    batch_metrics = []
+    for i in range(n_batches):
+        log = {}
+        for b in bins[start + i * per_batch : start + (i + 1) * per_batch]:
+            log.update(b)
+
+        met = calculate_metrics(log)
+        for k in met.keys():
+            if k != 'avg_wait_time':
+                met[k] = met[k] * OPEN_TIME / batch_length
+
+        batch_metrics.append(met)
+
+    metrics = {}
+    ci = {}
+    for k in batch_metrics[0].keys():
+        values = [m[k] for m in batch_metrics]
+        mean = sum(values) / n_batches
+        std_err = math.sqrt(sum((x - mean) ** 2 for x in values) / (n_batches - 1) / n_batches)
+        t = t_quantile(n_batches - 1)
+
+        metrics[k] = mean
+        ci[k] = (mean - t * std_err, mean + t * std_err)
+
+    return {
+        'metrics' : metrics,
+        'ci' : ci,
+        'warmup' : start * bin_width,
+        'batch_length' : batch_length,
+    }
+
+
+def longest_wait(night):
+    # longest wait so far, counting parties still in the queue so that
+    # clones are made while the party that got there can still wait longer
+    if not night.is_open():
+        return night.max_wait
+
+    return max([night.max_wait] + [night.t - night.party_log[p[0]]['a_time'] for p in night.to_seat])
+
+
+def dropped_fraction(night):
+    # fraction of parties so far that left without being seated - anyone
+    # still in the queue counts as dropped once the restaurant closes
+    if night.pid == 0:
+        return 0.0
+
+    dropped = night.pid - night.parties_seated
+    if night.is_open():
+        dropped -= len(night.to_seat)
+
+    return dropped / night.pid
+
+
+def long_wait(minutes):
+    # true if any party waited longer than minutes, seated or reneged
+    def event(results):
+        for v in results.values():
+            if v['s_time'] != -1:
+                end = v['s_time']
+            elif v['r_time'] != -1:
+                end = v['r_time']
+            else:
+                continue
+
+            if end - v['a_time'] > minutes:
+                return True
+
+        return False
+
+    return event
+
+
+def mass_renege(fraction):
+    # true if more than fraction of the parties were dropped
+    def event(results):
+        if not results:
+            return False
+
+        dropped = sum(1 for v in results.values() if v['s_time'] == -1)
+        return dropped > fraction * len(results)
+
+    return event
+
+
+def check_redraw(restaurant, seater, arrival_func, seated_time_func, renege_func, t_max, every=5, n=1000):
+    # runs n nights as usual and n nights that call redraw every `every`
+    # minutes, and gives the mean and standard error of each metric for both.
+    # redraw must not change what a night looks like, so they should agree
+    totals = {}
+
+    for name in ['plain', 'redraw']:
+        values = {}
+        for i in range(n):
+            night = Night(restaurant.copy(), copy.deepcopy(seater), arrival_func,
+                          seated_time_func, renege_func, t_max)
+            check = every
+            while not night.is_done():
+                night.step()
+                if name == 'redraw' and night.t >= check:
+                    night.redraw()
+                    check = night.t + every
+
+            met = calculate_metrics(night.party_log)
+            met['parties'] = len(night.party_log)
+            met['longest_wait'] = night.max_wait
+            for k, v in met.items():
+                values.setdefault(k, []).append(v)
+
+        totals[name] = {}
+        for k, v in values.items():
+            mean = sum(v) / n
+            std_err = math.sqrt(sum((x - mean) ** 2 for x in v) / (n - 1) / n)
+            totals[name][k] = (mean, std_err)
+
+    return totals
+
+
+def multilevel_split(restaurant, seater, arrival_func, seated_time_func, renege_func, t_max,
+                     event_func, level_func, levels, n=100, reps=10):
+    # estimates the probability that event_func(results) is true for a night
+    # with fixed effort multilevel splitting: each stage runs n nights until
+    # level_func(night) reaches the next level or the night ends, then the
+    # nights that made it are cloned back up to n for the next stage (each
+    # clone redraws its future, see Night.redraw). the product of the stage
+    # fractions is unbiased as long as every night where event_func is true
+    # reaches all the levels (e.g. longest_wait with levels below the minutes
+    # given to long_wait). reps independent runs give the confidence
+    # interval. if every run comes back 0 there is no interval to give, so ci
+    # is None and degenerate is set - add levels or raise n
+    #
+    # picking levels: space them so roughly a third to a half of the nights
+    # make it through each stage - run one rep with small n to see the
+    # fractions. fewer, wider levels starve the later stages and more levels
+    # just add stages. a run costs a bit more than reps * n nights, since bad
+    # nights have long queues, so it only pays off for rare events. with
+    # SmallestCombining and levels every 15 minutes of longest_wait it took
+    # 1.2 to 8 times less work than sampling nights for the same error, for
+    # events from 1 in 30 to 1 in 2000. for anything more common just sample
+    assert reps >= 2, 'need at least 2 reps for a confidence interval!'
+    estimates = []
+
+    for r in range(reps):
+        nights = [Night(restaurant.copy(), copy.deepcopy(seater), arrival_func,
+                        seated_time_func, renege_func, t_max) for i in range(n)]
+        p = 1.0
+
+        for level in levels:
+            reached = []
+            for night in nights:
+                while level_func(night) < level and not night.is_done():
+                    night.step()
+
+                if level_func(night) >= level:
+                    reached.append(night)
+
+            p *= len(reached) / n
+            if not reached:
+                break
+
+            nights = [random.choice(reached).clone() for i in range(n)]
+            for night in nights:
+                night.redraw()
+
+        # the last stage runs the survivors to the end of the night
+        if p > 0:
+            hits = sum(1 for night in nights if event_func(night.run()))
+            p *= hits / n
+
+        estimates.append(p)
+
+    p = sum(estimates) / reps
+    var = sum((e - p) ** 2 for e in estimates) / (reps - 1)
+    std_err = math.sqrt(var / reps)
+    t = t_quantile(reps - 1)
+
+    degenerate = p == 0
+    if degenerate:
+        ci = None
+    else:
+        ci = (max(0.0, p - t * std_err), min(1.0, p + t * std_err))
+
+    return {
+        'probability' : p,
+        'std_err' : std_err,
+        'ci' : ci,
+        'degenerate' : degenerate,
+        'estimates' : estimates,
+    }
+
+
 def main():
     # to try a different algorithm, just replace seater with another
     # class - the class will only be called by seater.find_seats